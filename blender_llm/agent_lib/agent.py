@@ -2,11 +2,13 @@
 
 import logging
 import json
+import os
 from enum import StrEnum
 from openai import OpenAI
 
 import constants
 import utils
+from journal import IMAGE_REF_TYPE, BlobStore, ConversationJournal, hash_payload
 
 logger = logging.getLogger(__name__)
 logging.basicConfig(filename=f"{__name__}.log", level=logging.INFO)
@@ -29,6 +31,7 @@ class Agent:
         openai_ai_token (str): The token for authenticating with the OpenAI API.
         client (OpenAI): An instance of the OpenAI client for making API calls.
         conversation (list): A list that stores the conversation history.
+        journal (ConversationJournal): Journal every conversation message is appended to, if any.
     """
 
     def __init__(
@@ -38,6 +41,7 @@ class Agent:
         response_template: dict = None,
         allowed_api_calls_per_prompt: int = 3,
         opena_ai_token: str = None,
+        journal: ConversationJournal = None,
     ):
         """
         Initializes an Agent instance.
@@ -48,6 +52,8 @@ class Agent:
             response_template (dict, optional): A template to validate the response. Defaults to None.
             allowed_api_calls_per_prompt (int, optional): Number of API calls allowed for response correction. Defaults to 3.
             opena_ai_token (str, optional): Token for OpenAI API. Must be set as env variable if not provided. Defaults to None.
+            journal (ConversationJournal, optional): Journal to persist the conversation to. If it already holds
+                                                     a session, the conversation is restored from it. Defaults to None.
         """
         logger.info(f"Creating new agent for model: {model}")
         self.openai_model = model
@@ -58,6 +64,8 @@ class Agent:
         ]
         self.response_template = response_template
         self.allowed_api_calls_per_prompt = allowed_api_calls_per_prompt
+        self.journal = journal
+        self._resume_or_start_journal()
 
     def inference(self, prompt: str):
         """
@@ -71,9 +79,9 @@ class Agent:
                    and the updated conversation history.
         """
         logger.info(f"Agent inference with prompt: {prompt}")
-        self.conversation.append({"role": "user", "content": prompt})
+        self._append_message({"role": "user", "content": prompt})
         raw_output = self._complete()
-        self.conversation.append({"role": "system", "content": raw_output})
+        self._append_message({"role": "system", "content": raw_output})
 
         if self.response_template is None:
             return raw_output, self.conversation
@@ -90,7 +98,7 @@ class Agent:
                              It can end with .json or don't have extension.
         """
         if file_name.endswith(".json"):
-            file_name = file_name.split(".")[0]
+            file_name = os.path.splitext(file_name)[0]
         with open(f"{file_name}.json", "w") as output_file:
             json.dump(self.conversation, output_file, indent=2)
 
@@ -100,6 +108,39 @@ class Agent:
         self.conversation = [
             {"role": "system", "content": self.system_prompt},
         ]
+        if self.journal is not None:
+            self.journal.clear()
+            self.journal.append(self.conversation[0])
+
+    def close(self):
+        """Closes the conversation journal if there is one"""
+        if self.journal is not None:
+            self.journal.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _resume_or_start_journal(self):
+        """Restores conversation from the journal if it holds a session, otherwise journals the system prompt"""
+        if self.journal is None:
+            return
+        conversation = self.journal.replay() if self.journal.exists() else []
+        if conversation:
+            self.conversation = conversation
+            logger.info(
+                f"Resumed conversation with {len(self.conversation)} messages from {self.journal.path}"
+            )
+        else:
+            self.journal.append(self.conversation[0])
+
+    def _append_message(self, message: dict):
+        """Appends message to the conversation and to the journal if there is one"""
+        self.conversation.append(message)
+        if self.journal is not None:
+            self.journal.append(message)
 
     def _complete(self):
         """
@@ -137,7 +178,7 @@ class Agent:
                     f"""LLM response not parsable as json, attempting to fix \
                     this prompt {i}/{self.allowed_api_calls_per_prompt} times"""
                 )
-                self.conversation.append(
+                self._append_message(
                     {"role": "user", "content": constants.JSON_NOT_PARSABLE}
                 )
                 parsable_response = self._complete()
@@ -154,7 +195,7 @@ class Agent:
                         attempting to fix this prompt: \
                         {i}/{self.allowed_api_calls_per_prompt} times"""
                     )
-                    self.conversation.append(
+                    self._append_message(
                         {
                             "role": "user",
                             "content": constants.JSON_NOT_CONFORMING_TO_TEMPLATE,
@@ -171,24 +212,60 @@ class Agent:
         raise LLMFaileToCreateValidJson
 
 class VisionAgent:
+    """
+    A class to create and manage an AI agent that describes images with the OpenAI API.
+
+    Attributes:
+        model (str): The model used by the agent for inference.
+        system_prompt (str): The initial prompt that sets the context for the conversation.
+        fidelity (str): Detail level images are sent with.
+        max_inline_images (int): Number of most recent images kept inline in the conversation, None keeps all.
+        image_store (BlobStore): Storage older images are spilled to before being removed from the conversation.
+        client (OpenAI): An instance of the OpenAI client for making API calls.
+        conversation (list): A list that stores the conversation history.
+        journal (ConversationJournal): Journal every conversation message is appended to, if any.
+    """
+
     def __init__(
         self,
         model: str,
         system_prompt: str,
         fidelity: str = "auto",
         opena_ai_token: str = None,
+        journal: ConversationJournal = None,
+        max_inline_images: int = None,
+        image_store: BlobStore = None,
     ):
         """
+        Initializes a VisionAgent instance.
 
+        Args:
+            model (str): The model to be used by the agent.
+            system_prompt (str): The system prompt that guides the agent's behavior.
+            fidelity (str, optional): Detail level images are sent with. Defaults to "auto".
+            opena_ai_token (str, optional): Token for OpenAI API. Must be set as env variable if not provided. Defaults to None.
+            journal (ConversationJournal, optional): Journal to persist the conversation to. If it already holds
+                                                     a session, the conversation is restored from it. Defaults to None.
+            max_inline_images (int, optional): Number of most recent images kept inline, older ones are replaced
+                                               by a placeholder with their hash and description. Defaults to None (keep all).
+            image_store (BlobStore, optional): Storage to spill replaced images to. Defaults to the journal blob store,
+                                               if there is no journal replaced images are dropped.
         """
         logger.info(f"Creating new agent for model: {model}")
         self.openai_model = model
         self.client = OpenAI()
         self.system_prompt = system_prompt
         self.fidelity = fidelity
+        self.max_inline_images = max_inline_images
+        if image_store is None and journal is not None:
+            image_store = journal.blobs
+        self.image_store = image_store
         self.conversation = [
             {"role": "system", "content": system_prompt},
         ]
+        self.journal = journal
+        self._resume_or_start_journal()
+        self._strip_old_images()
         
     def inference(self, prompt: str, image_path: str):
         """
@@ -202,7 +279,7 @@ class VisionAgent:
                    and the updated conversation history.
         """
         logger.info(f"Agent inference with prompt: {prompt}")
-        self.conversation.append(
+        self._append_message(
             {
                 "role": "user", 
                 "content": [
@@ -217,18 +294,139 @@ class VisionAgent:
                 ]
             }
         )
+        # Strip before sending, so the request carries at most max_inline_images images
+        self._strip_old_images(keep_newest=True)
         raw_output = self._complete()
-        self.conversation.append({"role": "system", "content": raw_output})
+        self._append_message({"role": "system", "content": raw_output})
+        self._strip_old_images()
 
         return raw_output, self.conversation
 
+    def memory_usage(self):
+        """
+        Accounts for the size of the conversation kept in memory and sent with every request.
+
+        Returns:
+            dict: Number of messages, number of inline images, characters taken by inline images
+                  and characters taken by text.
+        """
+        usage = {
+            "messages": len(self.conversation),
+            "inline_images": 0,
+            "image_chars": 0,
+            "text_chars": 0,
+        }
+        for message in self.conversation:
+            content = message["content"]
+            if isinstance(content, str):
+                usage["text_chars"] += len(content)
+                continue
+            for part in content:
+                if part["type"] == "image_url":
+                    usage["inline_images"] += 1
+                    usage["image_chars"] += len(part["image_url"]["url"])
+                elif part["type"] == "text":
+                    usage["text_chars"] += len(part["text"])
+        return usage
+
     def clear_converstation(self):
         """Cleares conversation back to system prompt only"""
 
         self.conversation = [
             {"role": "system", "content": self.system_prompt},
         ]
+        if self.journal is not None:
+            self.journal.clear()
+            self.journal.append(self.conversation[0])
+
+    def close(self):
+        """Closes the conversation journal if there is one"""
+        if self.journal is not None:
+            self.journal.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _resume_or_start_journal(self):
+        """Restores conversation from the journal if it holds a session, otherwise journals the system prompt"""
+        if self.journal is None:
+            return
+        conversation = (
+            self.journal.replay(max_inline_images=self.max_inline_images)
+            if self.journal.exists()
+            else []
+        )
+        if conversation:
+            self.conversation = conversation
+            logger.info(
+                f"Resumed conversation with {len(self.conversation)} messages from {self.journal.path}"
+            )
+        else:
+            self.journal.append(self.conversation[0])
+
+    def _append_message(self, message: dict):
+        """Appends message to the conversation and to the journal if there is one"""
+        self.conversation.append(message)
+        if self.journal is not None:
+            self.journal.append(message)
     
+    def _strip_old_images(self, keep_newest: bool = False):
+        """
+        Replaces all but the last max_inline_images images in the conversation with a text placeholder
+        holding the image hash and the description generated for it. Image references left by journal
+        replay are replaced the same way. Journal is not affected.
+
+        Args:
+            keep_newest (bool, optional): Keep the newest image inline even if max_inline_images is 0,
+                                          used for the image about to be sent. Defaults to False.
+        """
+        if self.max_inline_images is None:
+            return
+
+        inline_images_left = self.max_inline_images
+        if keep_newest:
+            inline_images_left = max(inline_images_left, 1)
+        for index in range(len(self.conversation) - 1, -1, -1):
+            message = self.conversation[index]
+            content = message["content"]
+            if isinstance(content, str):
+                continue
+
+            description = ""
+            if index + 1 < len(self.conversation) and isinstance(
+                self.conversation[index + 1]["content"], str
+            ):
+                description = self.conversation[index + 1]["content"]
+            stripped_content = []
+            images_removed = 0
+            for part in reversed(content):
+                if part["type"] == "image_url" and inline_images_left > 0:
+                    inline_images_left -= 1
+                elif part["type"] in ("image_url", IMAGE_REF_TYPE):
+                    if part["type"] == IMAGE_REF_TYPE:
+                        digest = part["hash"]
+                    elif self.image_store is not None:
+                        digest = self.image_store.put(part["image_url"]["url"])
+                    else:
+                        digest = hash_payload(part["image_url"]["url"])
+                    part = {
+                        "type": "text",
+                        "text": constants.IMAGE_PLACEHOLDER.format(
+                            hash=digest, description=description
+                        ),
+                    }
+                    images_removed += 1
+                stripped_content.append(part)
+            if images_removed:
+                stripped_content.reverse()
+                self.conversation[index] = dict(message, content=stripped_content)
+                logger.info(
+                    f"Removed {images_removed} images from conversation message {index}"
+                )
+
     def _complete(self):
         """
         Completes the current conversation by sending it to the OpenAI API and receiving a response.
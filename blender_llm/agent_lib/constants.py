@@ -1,2 +1,3 @@
 JSON_NOT_PARSABLE = "It is not parsable as json, fix it"
 JSON_NOT_CONFORMING_TO_TEMPLATE = "It doesnt't conform to the json template provided"
+IMAGE_PLACEHOLDER = "[Image {hash} removed from history, its description was: {description}]"
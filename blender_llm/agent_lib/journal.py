@@ -0,0 +1,334 @@
+# pylint: disable=W1203
+
+import hashlib
+import json
+import logging
+import os
+import zlib
+
+logger = logging.getLogger(__name__)
+
+IMAGE_REF_TYPE = "image_ref"
+# Every compressed record ends with a sync flush, which ends with this empty stored block
+SYNC_FLUSH_MARKER = b"\x00\x00\xff\xff"
+
+
+class JournalCorrupted(Exception):
+    """Raise when a journal record in the middle of the journal can't be decoded \
+    or references an image blob that is missing from the blob store"""
+
+
+def hash_payload(payload: str):
+    """Returns sha256 hex digest of a string payload"""
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class BlobStore:
+    """
+    Content addressed storage for image payloads, keyed by sha256 of the payload.
+
+    Attributes:
+        directory (str): Directory where blobs are stored, one file per payload.
+    """
+
+    def __init__(self, directory: str):
+        """
+        Initializes a BlobStore instance, creating the directory if needed.
+
+        Args:
+            directory (str): Directory where blobs are stored.
+        """
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def put(self, payload: str):
+        """
+        Stores payload if it is not stored yet.
+
+        Args:
+            payload (str): Payload to store, usually base64 image or data url.
+
+        Returns:
+            str: Hash the payload can be fetched back with.
+        """
+        digest = hash_payload(payload)
+        blob_path = self._blob_path(digest)
+        if not os.path.exists(blob_path):
+            temp_path = f"{blob_path}.tmp"
+            with open(temp_path, "w") as blob_file:
+                blob_file.write(payload)
+            os.replace(temp_path, blob_path)
+        return digest
+
+    def get(self, digest: str):
+        """
+        Loads payload stored under the hash.
+
+        Args:
+            digest (str): Hash returned by put.
+
+        Returns:
+            str: Stored payload.
+
+        Raises:
+            JournalCorrupted: If there is no blob for the hash.
+        """
+        try:
+            with open(self._blob_path(digest), "r") as blob_file:
+                return blob_file.read()
+        except FileNotFoundError as e:
+            raise JournalCorrupted(f"Missing image blob {digest}") from e
+
+    def _blob_path(self, digest: str):
+        return os.path.join(self.directory, f"{digest}.b64")
+
+
+class ConversationJournal:
+    """
+    Append-only JSONL journal of a conversation. Every message is written as a
+    single line when it is added, so checkpointing cost doesn't grow with the
+    length of the session. Image payloads are kept out of line in a BlobStore
+    and referenced from the journal by their hash.
+
+    Compressed journal is a single gzip deflate stream shared by all records,
+    every record is followed by a sync flush, so the stream can be cut back to
+    the end of any record. The stream is never finished, later sessions continue
+    it with raw deflate blocks. Record torn by an interrupted write is skipped on
+    replay and cut off the file before anything else is appended to it.
+
+    Attributes:
+        path (str): Path to the journal file.
+        compress (bool): Whether the journal is gzip compressed.
+        blobs (BlobStore): Storage for image payloads.
+    """
+
+    def __init__(self, path: str, compress: bool = None, blob_dir: str = None):
+        """
+        Initializes a ConversationJournal instance. The file is opened lazily
+        on first write, existing journal is appended to.
+
+        Args:
+            path (str): Path to the journal file.
+            compress (bool, optional): Gzip the journal. Defaults to True for paths ending with .gz.
+            blob_dir (str, optional): Directory for image blobs. Defaults to "<path>.blobs".
+        """
+        self.path = path
+        self.compress = path.endswith(".gz") if compress is None else compress
+        self.blobs = BlobStore(blob_dir or f"{path}.blobs")
+        self._file = None
+        self._compressor = None
+        self._valid_size = None
+
+    def exists(self):
+        """Returns True if the journal already holds some records"""
+        return os.path.exists(self.path) and os.path.getsize(self.path) > 0
+
+    def append(self, message: dict):
+        """
+        Writes a single conversation message to the journal.
+
+        Args:
+            message (dict): Message in OpenAI chat format.
+        """
+        self._write({"op": "message", "message": self._externalize(message)})
+
+    def clear(self):
+        """Records that the conversation was cleared, replay starts over from this point"""
+        self._write({"op": "clear"})
+
+    def replay(self, max_inline_images: int = None):
+        """
+        Rebuilds the conversation from the journal in a single pass.
+
+        Args:
+            max_inline_images (int, optional): Number of most recent images to load back from the blob store,
+                                               older ones are left as image_ref parts with their hash.
+                                               Defaults to None (load all).
+
+        Returns:
+            list: Conversation messages with image payloads inlined back.
+
+        Raises:
+            JournalCorrupted: If a record before the last one can't be decoded or blob is missing.
+        """
+        conversation = []
+        for record in self._scan():
+            if record["op"] == "clear":
+                conversation = []
+            elif record["op"] == "message":
+                conversation.append(record["message"])
+
+        images_left = max_inline_images
+        for index in range(len(conversation) - 1, -1, -1):
+            if images_left is not None and images_left <= 0:
+                break
+            conversation[index], images_loaded = self._internalize(
+                conversation[index], images_left
+            )
+            if images_left is not None:
+                images_left -= images_loaded
+        logger.info(f"Replayed {len(conversation)} messages from {self.path}")
+        return conversation
+
+    def close(self):
+        """Closes the journal file, it is reopened on next write"""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            self._compressor = None
+            # File may be appended to by someone else before it is reopened
+            self._valid_size = None
+
+    def _write(self, record: dict):
+        if self._file is None:
+            self._cut_torn_tail()
+            self._file = open(self.path, "ab")
+            if self.compress:
+                # Gzip header only at the start of the file, then raw deflate blocks
+                wbits = -zlib.MAX_WBITS if self._file.tell() > 0 else 31
+                self._compressor = zlib.compressobj(wbits=wbits)
+        line = (json.dumps(record, separators=(",", ":")) + "\n").encode("utf-8")
+        if self.compress:
+            line = self._compressor.compress(line) + self._compressor.flush(
+                zlib.Z_SYNC_FLUSH
+            )
+        self._file.write(line)
+        self._file.flush()
+
+    def _cut_torn_tail(self):
+        """Truncates the journal to the end of the last complete record"""
+        if not os.path.exists(self.path):
+            return
+        if self._valid_size is None:
+            for _ in self._scan():
+                pass
+        if os.path.getsize(self.path) > self._valid_size:
+            logger.warning(
+                f"Cutting torn record off journal {self.path} at byte {self._valid_size}"
+            )
+            os.truncate(self.path, self._valid_size)
+
+    def _scan(self):
+        """
+        Yields decoded journal records. Undecodable last record is treated as torn
+        write and skipped, size of the journal up to the end of the last complete
+        record is kept in _valid_size.
+
+        Raises:
+            JournalCorrupted: If a record followed by another record can't be decoded.
+        """
+        self._valid_size = 0
+        if not os.path.exists(self.path):
+            return
+
+        lines = self._compressed_lines() if self.compress else self._plain_lines()
+        torn_line_number = None
+        for line_number, (line, end_offset) in enumerate(lines, start=1):
+            if torn_line_number is not None:
+                raise JournalCorrupted(
+                    f"Journal {self.path} has invalid record on line {torn_line_number}"
+                )
+            if end_offset is not None and not line.strip():
+                self._valid_size = end_offset
+                continue
+            record = None
+            if end_offset is not None:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    pass
+            if record is None:
+                torn_line_number = line_number
+                continue
+            self._valid_size = end_offset
+            yield record
+
+        if torn_line_number is not None:
+            logger.warning(
+                f"Journal {self.path} ends with torn record on line {torn_line_number}"
+            )
+
+    def _plain_lines(self):
+        """Yields lines with offset they end at, offset is None for line missing its newline"""
+        end_offset = 0
+        with open(self.path, "rb") as journal_file:
+            for line in journal_file:
+                if not line.endswith(b"\n"):
+                    yield line, None
+                    return
+                end_offset += len(line)
+                yield line, end_offset
+
+    def _compressed_lines(self):
+        """Yields lines with offset of the sync flush they end at, offset is None for unfinished record"""
+        with open(self.path, "rb") as journal_file:
+            data = journal_file.read()
+
+        decompressor = zlib.decompressobj(wbits=31)
+        view = memoryview(data)
+        pending = b""
+        offset = 0
+        while offset < len(data):
+            flush_end = data.find(SYNC_FLUSH_MARKER, offset)
+            flush_end = len(data) if flush_end == -1 else flush_end + len(SYNC_FLUSH_MARKER)
+            try:
+                pending += decompressor.decompress(view[offset:flush_end])
+            except zlib.error as e:
+                raise JournalCorrupted(
+                    f"Journal {self.path} has invalid deflate data at byte {offset}"
+                ) from e
+            offset = flush_end
+            # Marker bytes can also show up inside compressed data, only a flush
+            # point that completes a record is a place the journal can be cut at
+            if pending.endswith(b"\n"):
+                for line in pending.splitlines(keepends=True):
+                    yield line, flush_end
+                pending = b""
+        if pending:
+            yield pending, None
+
+    def _externalize(self, message: dict):
+        """Replaces inline image payloads with references into the blob store"""
+        content = message.get("content")
+        if not isinstance(content, list):
+            return message
+
+        message = dict(message)
+        parts = []
+        for part in content:
+            if part.get("type") == "image_url":
+                part = {
+                    "type": IMAGE_REF_TYPE,
+                    "hash": self.blobs.put(part["image_url"]["url"]),
+                    "detail": part["image_url"].get("detail"),
+                }
+            parts.append(part)
+        message["content"] = parts
+        return message
+
+    def _internalize(self, message: dict, max_images: int = None):
+        """
+        Replaces last max_images image references with payloads loaded from the blob store.
+
+        Returns:
+            tuple: Message with images loaded and the number of images loaded.
+        """
+        content = message.get("content")
+        if not isinstance(content, list):
+            return message, 0
+
+        images_loaded = 0
+        parts = []
+        for part in reversed(content):
+            if part.get("type") == IMAGE_REF_TYPE and (
+                max_images is None or images_loaded < max_images
+            ):
+                image_url = {"url": self.blobs.get(part["hash"])}
+                if part.get("detail") is not None:
+                    image_url["detail"] = part["detail"]
+                part = {"type": "image_url", "image_url": image_url}
+                images_loaded += 1
+            parts.append(part)
+        parts.reverse()
+        message["content"] = parts
+        return message, images_loaded
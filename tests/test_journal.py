@@ -0,0 +1,166 @@
+import os
+import sys
+
+import pytest
+
+sys.path.append(
+    os.path.join(os.path.dirname(__file__), os.pardir, "blender_llm", "agent_lib")
+)
+
+from journal import ConversationJournal, JournalCorrupted  # noqa: E402
+
+SYSTEM_MESSAGE = {"role": "system", "content": "system prompt"}
+
+
+def image_message(text, url):
+    return {
+        "role": "user",
+        "content": [
+            {"type": "text", "text": text},
+            {"type": "image_url", "image_url": {"url": url, "detail": "auto"}},
+        ],
+    }
+
+
+@pytest.fixture(params=["session.jsonl", "session.jsonl.gz"])
+def journal_path(request, tmp_path):
+    return str(tmp_path / request.param)
+
+
+def test_append_replay_round_trip(journal_path):
+    conversation = [
+        SYSTEM_MESSAGE,
+        image_message("describe", "aW1hZ2U="),
+        {"role": "system", "content": "a cube"},
+    ]
+    journal = ConversationJournal(journal_path)
+    for message in conversation:
+        journal.append(message)
+    journal.close()
+
+    assert ConversationJournal(journal_path).replay() == conversation
+
+
+def test_clear_starts_replay_over(journal_path):
+    journal = ConversationJournal(journal_path)
+    journal.append(SYSTEM_MESSAGE)
+    journal.append({"role": "user", "content": "first"})
+    journal.clear()
+    journal.append(SYSTEM_MESSAGE)
+    journal.append({"role": "user", "content": "second"})
+    journal.close()
+
+    assert ConversationJournal(journal_path).replay() == [
+        SYSTEM_MESSAGE,
+        {"role": "user", "content": "second"},
+    ]
+
+
+def test_same_image_is_stored_once(journal_path):
+    journal = ConversationJournal(journal_path)
+    journal.append(image_message("first", "aW1hZ2U="))
+    journal.append(image_message("second", "aW1hZ2U="))
+    journal.append(image_message("third", "b3RoZXI="))
+    journal.close()
+
+    assert len(os.listdir(journal.blobs.directory)) == 2
+    with open(journal_path, "rb") as journal_file:
+        assert b"aW1hZ2U=" not in journal_file.read()
+
+
+def crash(journal):
+    """Closes only the file handle, leaving the journal the way a killed process would"""
+    journal._file.close()
+
+
+def test_resume_after_unclean_exit(journal_path):
+    journal = ConversationJournal(journal_path)
+    journal.append(SYSTEM_MESSAGE)
+    journal.append({"role": "user", "content": "first"})
+    # Simulate crash in the middle of writing the next record
+    size = os.path.getsize(journal_path)
+    journal.append({"role": "user", "content": "torn"})
+    crash(journal)
+    os.truncate(journal_path, size + (os.path.getsize(journal_path) - size) // 2)
+
+    resumed = ConversationJournal(journal_path)
+    assert resumed.replay() == [SYSTEM_MESSAGE, {"role": "user", "content": "first"}]
+    resumed.append({"role": "user", "content": "second"})
+    crash(resumed)
+
+    assert ConversationJournal(journal_path).replay() == [
+        SYSTEM_MESSAGE,
+        {"role": "user", "content": "first"},
+        {"role": "user", "content": "second"},
+    ]
+
+
+def test_append_after_close_keeps_records(journal_path):
+    journal = ConversationJournal(journal_path)
+    journal.append(SYSTEM_MESSAGE)
+    journal.close()
+
+    resumed = ConversationJournal(journal_path)
+    resumed.replay()
+    resumed.append({"role": "user", "content": "first"})
+    resumed.close()
+    resumed.append({"role": "user", "content": "second"})
+    resumed.close()
+
+    assert ConversationJournal(journal_path).replay() == [
+        SYSTEM_MESSAGE,
+        {"role": "user", "content": "first"},
+        {"role": "user", "content": "second"},
+    ]
+
+
+def test_compressed_journal_shares_stream_between_records(tmp_path):
+    sizes = {}
+    for name in ("session.jsonl", "session.jsonl.gz"):
+        journal = ConversationJournal(str(tmp_path / name))
+        for index in range(400):
+            journal.append(
+                {"role": "user", "content": f"Describe the objects seen by camera {index}"}
+            )
+        journal.close()
+        sizes[name] = os.path.getsize(journal.path)
+
+    assert sizes["session.jsonl.gz"] < sizes["session.jsonl"] / 5
+
+
+def test_append_without_replay_cuts_torn_record(tmp_path):
+    journal_path = str(tmp_path / "session.jsonl")
+    with open(journal_path, "w") as journal_file:
+        journal_file.write('{"op":"message","message":{"role":"system","content":"a"}}\n')
+        journal_file.write('{"op":"message","mess')
+
+    journal = ConversationJournal(journal_path)
+    journal.append({"role": "user", "content": "b"})
+    journal.close()
+
+    assert ConversationJournal(journal_path).replay() == [
+        {"role": "system", "content": "a"},
+        {"role": "user", "content": "b"},
+    ]
+
+
+def test_invalid_record_in_the_middle_is_corruption(tmp_path):
+    journal_path = str(tmp_path / "session.jsonl")
+    with open(journal_path, "w") as journal_file:
+        journal_file.write("not json\n")
+        journal_file.write('{"op":"message","message":{"role":"system","content":"a"}}\n')
+
+    with pytest.raises(JournalCorrupted):
+        ConversationJournal(journal_path).replay()
+
+
+def test_replay_loads_only_last_images(journal_path):
+    journal = ConversationJournal(journal_path)
+    journal.append(SYSTEM_MESSAGE)
+    journal.append(image_message("first", "Zmlyc3Q="))
+    journal.append(image_message("second", "c2Vjb25k"))
+    journal.close()
+
+    first, second = ConversationJournal(journal_path).replay(max_inline_images=1)[1:]
+    assert first["content"][1]["type"] == "image_ref"
+    assert second["content"][1]["image_url"]["url"] == "c2Vjb25k"
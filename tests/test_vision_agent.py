@@ -0,0 +1,107 @@
+import importlib.util
+import os
+import sys
+import types
+
+import pytest
+
+sys.path.append(
+    os.path.join(os.path.dirname(__file__), os.pardir, "blender_llm", "agent_lib")
+)
+
+if importlib.util.find_spec("openai") is None:
+    # Agents only construct the client, every test replaces it and _complete
+    sys.modules["openai"] = types.SimpleNamespace(OpenAI=None)
+
+import agent  # noqa: E402
+from agent import VisionAgent  # noqa: E402
+from journal import ConversationJournal  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def openai_client(monkeypatch):
+    monkeypatch.setattr(agent, "OpenAI", lambda: None)
+
+
+def image_parts(conversation):
+    return [
+        part
+        for message in conversation
+        if isinstance(message["content"], list)
+        for part in message["content"]
+        if part["type"] == "image_url"
+    ]
+
+
+def test_image_limit_applies_per_image():
+    vision_agent = VisionAgent(model="gpt-4o", system_prompt="system", max_inline_images=1)
+    vision_agent.conversation.append(
+        {
+            "role": "user",
+            "content": [
+                {"type": "text", "text": "describe"},
+                {"type": "image_url", "image_url": {"url": "Zmlyc3Q="}},
+                {"type": "image_url", "image_url": {"url": "c2Vjb25k"}},
+            ],
+        }
+    )
+    vision_agent.conversation.append({"role": "system", "content": "two cubes"})
+
+    vision_agent._strip_old_images()
+
+    assert image_parts(vision_agent.conversation) == [
+        {"type": "image_url", "image_url": {"url": "c2Vjb25k"}}
+    ]
+    assert "two cubes" in vision_agent.conversation[1]["content"][1]["text"]
+    assert vision_agent.memory_usage()["inline_images"] == 1
+
+
+def test_resume_keeps_image_limit(tmp_path):
+    journal_path = str(tmp_path / "session.jsonl")
+    vision_agent = VisionAgent(
+        model="gpt-4o",
+        system_prompt="system",
+        journal=ConversationJournal(journal_path),
+    )
+    for index in range(3):
+        render_path = tmp_path / f"{index}.png"
+        render_path.write_bytes(f"render {index}".encode())
+        vision_agent._complete = lambda: "a cube"
+        vision_agent.inference("describe", str(render_path))
+    vision_agent.close()
+
+    resumed = VisionAgent(
+        model="gpt-4o",
+        system_prompt="system",
+        journal=ConversationJournal(journal_path),
+        max_inline_images=1,
+    )
+
+    assert len(resumed.conversation) == 7
+    assert len(image_parts(resumed.conversation)) == 1
+    assert not any(
+        part["type"] == "image_ref"
+        for message in resumed.conversation
+        if isinstance(message["content"], list)
+        for part in message["content"]
+    )
+
+
+def test_request_holds_at_most_max_inline_images(tmp_path):
+    vision_agent = VisionAgent(
+        model="gpt-4o", system_prompt="system", max_inline_images=2
+    )
+    sent_images = []
+
+    def complete():
+        sent_images.append(len(image_parts(vision_agent.conversation)))
+        return "a cube"
+
+    vision_agent._complete = complete
+    for index in range(4):
+        render_path = tmp_path / f"{index}.png"
+        render_path.write_bytes(f"render {index}".encode())
+        vision_agent.inference("describe", str(render_path))
+
+    assert sent_images == [1, 2, 2, 2]
+    assert vision_agent.conversation[-2]["content"][1]["type"] == "image_url"